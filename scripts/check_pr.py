@@ -9,42 +9,38 @@ import os
 import re
 import sys
 import json
-import subprocess
-from pathlib import Path
 
-def call_report_check(title, summary, text, conclusion):
-    """调用 report_check.py 生成报告"""
-    script_dir = Path(__file__).parent
-    report_script = script_dir / "report_check.py"
-    
-    # 确保报告脚本存在
-    if not report_script.exists():
-        print(f"ERROR: 找不到报告脚本: {report_script}")
-        return False
-    
-    try:
-        subprocess.run([
-            "python", str(report_script),
-            "--title", title,
-            "--summary", summary,
-            "--text", text,
-            "--conclusion", conclusion
-        ], check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: 调用报告脚本失败: {e}")
-        return False
+from report_check import call_report_check
 
-def check_pr_title(title):
-    """Check if PR title matches the required pattern"""
-    pr_title_regex = os.environ.get("PR_TITLE_REGEX", r"^\[(Feature|Fix|Docs|Refactor|Test|Chore)\] .+")
-    
-    if not re.match(pr_title_regex, title):
-        message = f"""## PR 标题格式错误
+# PR 标题默认格式，可通过 PR_TITLE_REGEX 环境变量覆盖
+_DEFAULT_TITLE_RE = r"^\[(Feature|Fix|Docs|Refactor|Test|Chore)\] .+"
+PR_TITLE_REGEX = os.environ.get("PR_TITLE_REGEX", _DEFAULT_TITLE_RE)
+
+# 在模块加载时编译一次正则，避免每次调用都查找 re 的内部缓存
+_TITLE_RE = re.compile(PR_TITLE_REGEX)
+_SECTION_RE = re.compile(r'#+\s+\w+')
+
+# 最小有意义描述长度
+MIN_BODY_LENGTH = 50
+
+# 检查结果的报告文本
+_FAILURE_TITLE = "PR 格式验证失败"
+_FAILURE_SUMMARY = "PR 标题或描述不符合要求格式。"
+_SUCCESS_TITLE = "PR 格式检查通过"
+_SUCCESS_SUMMARY = "PR 标题和描述格式正确。"
+_SUCCESS_TEXT = """## ✅ PR 格式检查通过
+
+- 标题格式正确
+- 描述内容充分
+
+感谢您遵循项目规范！"""
+
+# 检查失败时的提示信息，只有标题模板需要填充
+_TITLE_ERR_TMPL = """## PR 标题格式错误
 
 您的 PR 标题 `{title}` 不符合要求的格式：
 ```
-{pr_title_regex}
+{regex}
 ```
 
 ### 正确的标题示例：
@@ -59,16 +55,8 @@ def check_pr_title(title):
 1. 点击 PR 标题旁边的编辑按钮（✏️）
 2. 修改标题以符合上述格式
 3. 点击保存"""
-        print(message)
-        return False, message
-    
-    print(f"✅ PR 标题格式正确：{title}")
-    return True, f"PR 标题 `{title}` 格式正确"
 
-def check_pr_body(body):
-    """Check if PR body is not empty and contains required sections"""
-    if not body or len(body.strip()) < 50:  # 最小有意义描述长度
-        message = """## PR 描述错误
+_BODY_ERR_MSG = """## PR 描述错误
 
 PR 描述太短或为空。请提供以下信息：
 
@@ -94,13 +82,8 @@ PR 描述太短或为空。请提供以下信息：
 4. 点击保存
 
 好的 PR 描述可以帮助审查者更好地理解您的改动，加快审查过程。"""
-        print(message)
-        return False, message
-    
-    # 检查最小结构（是否有带标题的章节）
-    warning_message = None
-    if not re.search(r'#+\s+\w+', body):
-        warning_message = """## ⚠️ PR 描述格式建议
+
+_BODY_WARN_MSG = """## ⚠️ PR 描述格式建议
 
 您的 PR 描述缺少结构化的章节。建议使用 Markdown 标题来组织描述：
 
@@ -119,6 +102,29 @@ PR 描述太短或为空。请提供以下信息：
 ```
 
 这种结构可以让审查者更容易理解您的改动。"""
+
+def check_pr_title(title):
+    """Check if PR title matches the required pattern"""
+    if not _TITLE_RE.match(title):
+        message = _TITLE_ERR_TMPL.format(title=title, regex=PR_TITLE_REGEX)
+        print(message)
+        return False, message
+    
+    print(f"✅ PR 标题格式正确：{title}")
+    return True, f"PR 标题 `{title}` 格式正确"
+
+def check_pr_body(body):
+    """Check if PR body is not empty and contains required sections"""
+    if not body or len(body.strip()) < MIN_BODY_LENGTH:
+        message = _BODY_ERR_MSG
+        print(message)
+        return False, message
+    
+    # 检查最小结构（是否有带标题的章节）
+    warning_message = None
+    # 先用子串检查快速排除没有 "#" 的描述，再运行正则
+    if '#' not in body or not _SECTION_RE.search(body):
+        warning_message = _BODY_WARN_MSG
         print(warning_message)
         # 这只是一个警告，不导致检查失败
     
@@ -140,8 +146,8 @@ def main():
     # 准备检查结果
     if not (title_valid and body_valid):
         conclusion = "failure"
-        title = "PR 格式验证失败"
-        summary = "PR 标题或描述不符合要求格式。"
+        title = _FAILURE_TITLE
+        summary = _FAILURE_SUMMARY
         text = f"{title_message}\n\n{body_message}"
         
         print("❌ PR 格式验证失败。请修复上述问题。")
@@ -152,14 +158,9 @@ def main():
         sys.exit(1)
     else:
         conclusion = "success"
-        title = "PR 格式检查通过"
-        summary = "PR 标题和描述格式正确。"
-        text = """## ✅ PR 格式检查通过
-
-- 标题格式正确
-- 描述内容充分
-
-感谢您遵循项目规范！"""
+        title = _SUCCESS_TITLE
+        summary = _SUCCESS_SUMMARY
+        text = _SUCCESS_TEXT
         
         print("✅ PR 格式验证通过。")
         
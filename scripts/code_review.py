@@ -6,16 +6,112 @@ Uses OpenAI's API to perform automated code review on PR changes.
 """
 
 import os
+import re
 import sys
 import json
 import time
+import random
+import hashlib
+import functools
+import tempfile
 import requests
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from openai import OpenAI, RateLimitError, APIConnectionError, APITimeoutError, BadRequestError
 from pathlib import Path
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-def get_pr_diff():
-    """Fetch the PR diff from GitHub API"""
+from report_check import call_report_check
+
+# 所有 GitHub 请求共用一个 Session，复用 TCP/TLS 连接并对临时错误自动重试
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504))
+))
+_SESSION.headers.update({
+    "Accept": "application/vnd.github.v3+json",
+    "Authorization": f"token {os.environ.get('GITHUB_TOKEN')}",
+})
+
+# 设置 REVIEW_CACHE=1 时按 (模型, prompt) 的哈希缓存审查结果，重复运行时相同版本的文件无需再次调用 API
+REVIEW_CACHE_ENABLED = os.environ.get('REVIEW_CACHE') == '1'
+REVIEW_CACHE_DIR = Path(os.environ.get('REVIEW_CACHE_DIR', '/tmp/pr-review-cache'))
+
+# 审查结果的 JSON Schema，由 API 的 structured outputs 保证返回格式
+_REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer", "description": "1-10 的整数评分"},
+        "issues": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "type": {"type": "string", "enum": ["bug", "performance", "security", "style", "best_practice"]},
+                    "severity": {"type": "string", "enum": ["high", "medium", "low"]},
+                    "description": {"type": "string", "description": "问题描述"},
+                    "suggestion": {"type": "string", "description": "改进建议"},
+                    "line_number": {"type": ["string", "null"], "description": "相关行号（如果适用）"}
+                },
+                "required": ["type", "severity", "description", "suggestion", "line_number"],
+                "additionalProperties": False
+            }
+        },
+        "summary": {"type": "string", "description": "总体评价"},
+        "positive_aspects": {"type": "array", "items": {"type": "string"}, "description": "值得表扬的方面列表"}
+    },
+    "required": ["score", "issues", "summary", "positive_aspects"],
+    "additionalProperties": False
+}
+
+# 较早的模型不支持 structured outputs，改用 JSON 模式时在 prompt 中附上 schema
+_STRUCTURED_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "code_review", "strict": True, "schema": _REVIEW_SCHEMA}
+}
+_SCHEMA_PROMPT = f"""
+请只返回一个符合以下 JSON Schema 的 JSON 对象：
+{json.dumps(_REVIEW_SCHEMA, ensure_ascii=False, indent=2)}
+"""
+
+_EMOJI_MAP = {
+    "bug": "🐛",
+    "performance": "⚡",
+    "security": "🔒",
+    "style": "💅",
+    "best_practice": "✨"
+}
+
+_SEVERITY_MAP = {
+    "high": "🔴",
+    "medium": "🟡",
+    "low": "🟢"
+}
+
+# 预先生成所有 (类型, 严重性) 组合的问题标题
+_ISSUE_HEADER = {
+    (issue_type, severity): f"{emoji} {severity_emoji} {issue_type.title()}"
+    for issue_type, emoji in _EMOJI_MAP.items()
+    for severity, severity_emoji in _SEVERITY_MAP.items()
+}
+
+# 单次审查的最大 token 数，按约 4 个字符 1 个 token 估算
+MAX_REVIEW_TOKENS = int(os.environ.get('MAX_REVIEW_TOKENS', 8000))
+MAX_REVIEW_CHARS = MAX_REVIEW_TOKENS * 4
+
+# 遵循 Retry-After 时最多等待的秒数，避免单个线程长时间阻塞
+MAX_RETRY_WAIT = 30
+
+# 并发审查的最大文件数，受 OpenAI 单个密钥的并发限制约束
+MAX_REVIEW_WORKERS = 8
+
+# 分块审查时从 line_number 中提取行号
+_LINE_NUMBER_RE = re.compile(r'\d+')
+
+def get_changed_files():
+    """Fetch the list of changed files in the PR"""
     token = os.environ.get('GITHUB_TOKEN')
     pr_number = os.environ.get('PR_NUMBER')
     repo = os.environ.get('REPO_FULL_NAME')
@@ -24,49 +120,11 @@ def get_pr_diff():
         print("❌ 缺少必要的环境变量")
         sys.exit(1)
     
-    print(f"DEBUG: 获取 PR #{pr_number} 的差异内容，仓库: {repo}")
-    print(f"DEBUG: 使用的令牌 (前4位): {token[:4]}...")
-    
-    url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}"
-    headers = {
-        "Accept": "application/vnd.github.v3.diff",
-        "Authorization": f"token {token}",
-    }
-    
-    try:
-        response = requests.get(url, headers=headers)
-        print(f"DEBUG: 响应状态码: {response.status_code}")
-        
-        if response.status_code == 200:
-            print(f"INFO: 成功获取差异，内容长度: {len(response.text)} 字符")
-            return response.text
-        
-        response.raise_for_status()
-    except Exception as e:
-        print(f"ERROR: 获取 PR 差异失败: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"响应状态: {e.response.status_code}")
-            print(f"响应内容: {e.response.text}")
-        sys.exit(1)
-    
-    return None
-
-def get_changed_files():
-    """Fetch the list of changed files in the PR"""
-    token = os.environ.get('GITHUB_TOKEN')
-    pr_number = os.environ.get('PR_NUMBER')
-    repo = os.environ.get('REPO_FULL_NAME')
-    
-    print(f"DEBUG: 获取 PR #{pr_number} 中更改的文件")
+    print(f"DEBUG: 获取 PR #{pr_number} 中更改的文件，仓库: {repo}")
     
     url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}/files"
-    headers = {
-        "Accept": "application/vnd.github.v3+json",
-        "Authorization": f"token {token}",
-    }
-    
     try:
-        response = requests.get(url, headers=headers)
+        response = _SESSION.get(url)
         print(f"DEBUG: 响应状态码: {response.status_code}")
         
         if response.status_code == 200:
@@ -84,10 +142,61 @@ def get_changed_files():
     
     return []
 
+def write_cache_file(path, write):
+    """先写临时文件再替换，保证缓存文件始终完整"""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=path.parent, suffix='.tmp', delete=False) as f:
+            write(f)
+        os.replace(f.name, path)
+    except OSError as e:
+        print(f"WARNING: 写入缓存失败: {e}")
+
+def get_file_content(file):
+    """通过 Git Blobs API 获取文件内容"""
+    sha = file['sha']
+    repo = os.environ.get('REPO_FULL_NAME')
+    url = f"https://api.github.com/repos/{repo}/git/blobs/{sha}"
+    print(f"DEBUG: 获取文件内容: {file['filename']} ({sha[:7]})")
+    
+    response = _SESSION.get(url, headers={"Accept": "application/vnd.github.raw"})
+    if response.status_code != 200:
+        print(f"WARNING: 无法获取文件内容，状态码: {response.status_code}")
+        return None
+    
+    return response.content.decode('utf-8', errors='replace')
+
+@functools.lru_cache(maxsize=1)
+def get_openai_client():
+    """所有审查线程共用一个 OpenAI 客户端及其连接池
+
+    关闭 SDK 自带的重试，由 review_code_with_llm 的重试循环统一处理临时错误。
+    """
+    return OpenAI(api_key=os.environ['OPENAI_API_KEY'], max_retries=0)
+
+def request_review(prompt, model_name, response_format):
+    """调用一次 OpenAI API，返回审查结果的 JSON 文本"""
+    response = get_openai_client().chat.completions.create(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.3,
+        response_format=response_format
+    )
+    return response.choices[0].message.content
+
+def check_review_result(review_result):
+    """检查审查结果包含后续处理用到的字段，JSON 模式下模型可能不遵循 schema"""
+    if not isinstance(review_result, dict) or not all(key in review_result for key in _REVIEW_SCHEMA['required']):
+        raise ValueError("审查结果缺少必要字段")
+    issue_keys = _REVIEW_SCHEMA['properties']['issues']['items']['required']
+    if not all(isinstance(issue, dict) and all(key in issue for key in issue_keys)
+               for issue in review_result['issues']):
+        raise ValueError("审查结果中的问题缺少必要字段")
+
 def review_code_with_llm(file_content, file_name):
     """使用 LLM 审查代码"""
     api_key = os.environ.get('OPENAI_API_KEY')
-    model_name = os.environ.get('MODEL_NAME', 'gpt-4')
+    model_name = os.environ.get('MODEL_NAME', 'gpt-4o-mini')
     
     if not api_key:
         print("❌ Error: OPENAI_API_KEY environment variable is not set")
@@ -95,8 +204,6 @@ def review_code_with_llm(file_content, file_name):
     
     print(f"DEBUG: 使用 {model_name} 审查文件: {file_name}")
     
-    client = OpenAI(api_key=api_key)
-    
     prompt = f"""
 作为一个专业的代码审查者，请审查以下代码变更。这是文件 {file_name} 的内容：
 
@@ -107,70 +214,150 @@ def review_code_with_llm(file_content, file_name):
 2. 潜在问题：识别可能的 bug、性能问题或安全漏洞
 3. 最佳实践：检查是否遵循编程最佳实践
 4. 改进建议：提供具体的改进建议
-
-请以 JSON 格式返回结果：
-{{
-    "score": [1-10的整数评分],
-    "issues": [
-        {{
-            "type": ["bug" | "performance" | "security" | "style" | "best_practice"],
-            "severity": ["high" | "medium" | "low"],
-            "description": "问题描述",
-            "suggestion": "改进建议",
-            "line_number": "相关行号（如果适用）"
-        }}
-    ],
-    "summary": "总体评价",
-    "positive_aspects": ["值得表扬的方面列表"]
-}}
 """
 
+    cache_key = hashlib.sha256(f"{model_name}\0{prompt}".encode('utf-8')).hexdigest()
+    cache_file = REVIEW_CACHE_DIR / f"{cache_key}.json"
+    if REVIEW_CACHE_ENABLED:
+        try:
+            review_result = json.loads(cache_file.read_text(encoding='utf-8'))
+            print(f"INFO: 使用缓存的审查结果: {file_name}")
+            return review_result
+        except (OSError, ValueError):
+            pass
+    
     max_retries = 3
     retry_delays = [1, 2, 4]
+    review_prompt = prompt
+    response_format = _STRUCTURED_FORMAT
     
     for retry_count, delay in enumerate(retry_delays):
         try:
             print(f"DEBUG: 尝试 #{retry_count+1} 调用 OpenAI API")
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
+            try:
+                content = request_review(review_prompt, model_name, response_format)
+            except BadRequestError as e:
+                if response_format is not _STRUCTURED_FORMAT:
+                    raise
+                # 模型不支持 structured outputs 时改用 JSON 模式重试一次，而不是直接放弃审查
+                print(f"WARNING: {model_name} 不支持 structured outputs，改用 JSON 模式: {e}")
+                review_prompt = prompt + _SCHEMA_PROMPT
+                response_format = {"type": "json_object"}
+                content = request_review(review_prompt, model_name, response_format)
             
-            content = response.choices[0].message.content
             print("INFO: API 调用成功，分析结果已返回")
-            return json.loads(content)
+            review_result = json.loads(content)
+            check_review_result(review_result)
+            if REVIEW_CACHE_ENABLED:
+                data = content.encode('utf-8')
+                write_cache_file(cache_file, lambda f: f.write(data))
+            return review_result
             
-        except Exception as e:
+        except (RateLimitError, APIConnectionError, APITimeoutError) as e:
             if retry_count == len(retry_delays) - 1:
                 print(f"ERROR: LLM 审查出错: {e}")
                 return None
-            print(f"WARNING: 重试 {retry_count + 1}/{len(retry_delays)}, {delay}秒后: {e}")
-            time.sleep(delay)
+            
+            # 优先遵循服务端返回的 Retry-After，否则加入随机抖动，避免多个线程同时重试
+            response = getattr(e, 'response', None)
+            try:
+                wait = min(float(response.headers.get('retry-after')), MAX_RETRY_WAIT)
+            except (AttributeError, TypeError, ValueError):
+                wait = delay * random.uniform(0.75, 1.25)
+            
+            print(f"WARNING: 重试 {retry_count + 1}/{len(retry_delays)}, {wait:.1f}秒后: {e}")
+            time.sleep(wait)
+        except Exception as e:
+            # 认证失败、请求无效、结果无法解析等错误，重试也不会成功
+            print(f"ERROR: LLM 审查出错: {e}")
+            return None
     
     return None
 
+def split_into_chunks(content, max_chars):
+    """按行把内容切分为不超过 max_chars 的块，返回 (起始行号, 内容) 列表"""
+    chunks = []
+    lines = []
+    size = 0
+    start_line = 1
+    for line_number, line in enumerate(content.splitlines(keepends=True), 1):
+        if lines and size + len(line) > max_chars:
+            chunks.append((start_line, ''.join(lines)))
+            lines, size, start_line = [], 0, line_number
+        lines.append(line)
+        size += len(line)
+    if lines:
+        chunks.append((start_line, ''.join(lines)))
+    return chunks
+
+def merge_reviews(results):
+    """合并分块审查的结果，按 (type, description) 去重"""
+    if not results:
+        return None
+    
+    issues = []
+    seen = set()
+    for result in results:
+        for issue in result['issues']:
+            key = (issue['type'], issue['description'])
+            if key not in seen:
+                seen.add(key)
+                issues.append(issue)
+    
+    return {
+        'score': min(result['score'] for result in results),
+        'issues': issues,
+        'summary': '\n\n'.join(result['summary'] for result in results),
+        'positive_aspects': list(dict.fromkeys(
+            aspect for result in results for aspect in result['positive_aspects']
+        ))
+    }
+
+def review_file_content(file_content, file_name, patch=None):
+    """根据内容大小选择审查整个文件、只审查 diff 或分块审查"""
+    if len(file_content) // 4 <= MAX_REVIEW_TOKENS:
+        return review_code_with_llm(file_content, file_name)
+    
+    if patch and len(patch) // 4 <= MAX_REVIEW_TOKENS:
+        print(f"INFO: 文件 {file_name} 超过 {MAX_REVIEW_TOKENS} tokens，只审查 diff")
+        review_result = review_code_with_llm(patch, f"{file_name} (diff)")
+        # diff 中的行号与文件行号对不上，不能用于定位
+        if review_result:
+            for issue in review_result['issues']:
+                issue['line_number'] = None
+        return review_result
+    
+    chunks = split_into_chunks(file_content, MAX_REVIEW_CHARS)
+    print(f"INFO: 文件 {file_name} 超过 {MAX_REVIEW_TOKENS} tokens，分 {len(chunks)} 块审查")
+    
+    results = []
+    for index, (start_line, chunk) in enumerate(chunks, 1):
+        review_result = review_code_with_llm(chunk, f"{file_name} (第 {index}/{len(chunks)} 部分)")
+        if not review_result:
+            continue
+        # 把块内行号换算为文件行号
+        for issue in review_result['issues']:
+            match = _LINE_NUMBER_RE.search(str(issue.get('line_number') or ''))
+            if match:
+                issue['line_number'] = str(int(match.group()) + start_line - 1)
+        results.append(review_result)
+    
+    return merge_reviews(results)
+
+def issue_header(issue):
+    """返回问题的标题，例如 🐛 🔴 Bug"""
+    header = _ISSUE_HEADER.get((issue['type'], issue['severity']))
+    if header is None:
+        header = f"{_EMOJI_MAP.get(issue['type'], '❓')} {_SEVERITY_MAP.get(issue['severity'], '❓')} {issue['type'].title()}"
+    return header
+
 def format_review_for_file(file_name, review_result):
     """格式化单个文件的审查结果为 Markdown 格式"""
     if not review_result:
         return f"⚠️ 未能成功审查 {file_name}"
     
-    emoji_map = {
-        "bug": "🐛",
-        "performance": "⚡",
-        "security": "🔒",
-        "style": "💅",
-        "best_practice": "✨"
-    }
-    
-    severity_map = {
-        "high": "🔴",
-        "medium": "🟡",
-        "low": "🟢"
-    }
-    
-    text = f"""
+    positive_aspects = "\n".join(f"- {aspect}" for aspect in review_result['positive_aspects'])
+    parts = [f"""
 ## 代码审查结果: {file_name}
 
 ### 总体评分: {review_result['score']}/10
@@ -178,47 +365,48 @@ def format_review_for_file(file_name, review_result):
 {review_result['summary']}
 
 ### 值得表扬的方面 👏
-{chr(10).join([f"- {aspect}" for aspect in review_result['positive_aspects']])}
+{positive_aspects}
 
 ### 发现的问题
-"""
+"""]
     
     if review_result['issues']:
         for issue in review_result['issues']:
-            text += f"""
-#### {emoji_map.get(issue['type'], '❓')} {severity_map.get(issue['severity'], '❓')} {issue['type'].title()}
+            parts.append(f"""
+#### {issue_header(issue)}
 - **描述**: {issue['description']}
 - **建议**: {issue['suggestion']}
-"""
+""")
             if issue.get('line_number'):
-                text += f"- **位置**: 第 {issue['line_number']} 行\n"
+                parts.append(f"- **位置**: 第 {issue['line_number']} 行\n")
     else:
-        text += "\n没有发现重要问题。\n"
+        parts.append("\n没有发现重要问题。\n")
     
-    return text
+    return "".join(parts)
 
-def call_report_check(title, summary, text, conclusion):
-    """调用 report_check.py 生成报告"""
-    script_dir = Path(__file__).parent
-    report_script = script_dir / "report_check.py"
+def review_file(file):
+    """获取单个文件的内容并使用 LLM 审查，跳过的文件返回 None"""
+    file_name = file['filename']
+    print(f"📝 正在审查文件: {file_name}")
     
-    # 确保报告脚本存在
-    if not report_script.exists():
-        print(f"ERROR: 找不到报告脚本: {report_script}")
-        return False
+    # 跳过二进制文件、删除的文件等
+    if file['status'] == 'removed' or file.get('binary', False):
+        print(f"INFO: 跳过文件 {file_name} (状态: {file['status']})")
+        return None
     
+    # 获取文件内容
     try:
-        subprocess.run([
-            "python", str(report_script),
-            "--title", title,
-            "--summary", summary,
-            "--text", text,
-            "--conclusion", conclusion
-        ], check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: 调用报告脚本失败: {e}")
-        return False
+        file_content = get_file_content(file)
+        if file_content is None:
+            return None
+        
+        print(f"INFO: 成功获取文件内容，长度: {len(file_content)} 字符")
+    except Exception as e:
+        print(f"ERROR: 获取文件内容失败: {e}")
+        return None
+    
+    # 使用 LLM 进行代码审查
+    return file_name, review_file_content(file_content, file_name, file.get('patch'))
 
 def main():
     """主函数"""
@@ -227,9 +415,6 @@ def main():
     # 获取 PR 中更改的文件
     changed_files = get_changed_files()
     
-    # 获取 PR 的 diff (用于参考)
-    diff = get_pr_diff()
-    
     total_issues = 0
     high_severity_issues = 0
     max_files = int(os.environ.get('MAX_FILES_TO_REVIEW', 10))
@@ -241,37 +426,23 @@ def main():
     file_reviews = []
     issue_details = []
     reviewed_files = 0
+    failed_files = 0
     low_quality_files = 0
     
-    # 对每个更改的文件进行审查
-    for file in changed_files[:max_files]:
-        file_name = file['filename']
-        print(f"📝 正在审查文件: {file_name}")
-        
-        # 跳过二进制文件、删除的文件等
-        if file['status'] == 'removed' or file.get('binary', False):
-            print(f"INFO: 跳过文件 {file_name} (状态: {file['status']})")
-            continue
-        
-        # 获取文件内容
-        try:
-            print(f"DEBUG: 获取文件内容: {file['raw_url']}")
-            response = requests.get(file['raw_url'])
-            if response.status_code != 200:
-                print(f"WARNING: 无法获取文件内容，状态码: {response.status_code}")
-                continue
-                
-            file_content = response.text
-            print(f"INFO: 成功获取文件内容，长度: {len(file_content)} 字符")
-        except Exception as e:
-            print(f"ERROR: 获取文件内容失败: {e}")
+    # 并发获取并审查每个更改的文件（均为 I/O 密集操作）
+    files_to_review = changed_files[:max_files]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(files_to_review), MAX_REVIEW_WORKERS))) as executor:
+        results = list(executor.map(review_file, files_to_review))
+    
+    for result in results:
+        if result is None:
             continue
         
-        # 使用 LLM 进行代码审查
-        review_result = review_code_with_llm(file_content, file_name)
-        reviewed_files += 1
+        file_name, review_result = result
         
         if review_result:
+            reviewed_files += 1
+            
             # 统计问题
             file_issues = len(review_result['issues'])
             total_issues += file_issues
@@ -299,6 +470,10 @@ def main():
                     'suggestion': issue['suggestion'],
                     'line_number': issue.get('line_number')
                 })
+        else:
+            # 审查失败（例如模型不支持 structured outputs）的文件不计入已审查文件
+            failed_files += 1
+            file_reviews.append(format_review_for_file(file_name, review_result))
     
     # 准备总结报告
     if reviewed_files == 0:
@@ -311,16 +486,21 @@ def main():
             conclusion = "failure"
             title = "代码审查发现问题"
             summary = f"发现 {high_severity_issues} 个高严重性问题，{low_quality_files} 个低质量文件。"
+        elif failed_files > 0:
+            conclusion = "neutral"
+            title = "代码审查未完成"
+            summary = f"审查了 {reviewed_files} 个文件，{failed_files} 个文件未能审查。"
         else:
             conclusion = "success"
             title = "代码审查通过"
             summary = f"审查了 {reviewed_files} 个文件，无高严重性问题。"
     
     # 生成最终报告
-    report_text = f"""
+    report_header = f"""
 # 代码审查总结
 
 - 审查的文件数: {reviewed_files}
+- 未能审查的文件数: {failed_files}
 - 发现的问题总数: {total_issues}
 - 高严重性问题: {high_severity_issues}
 - 低质量文件数: {low_quality_files}
@@ -329,19 +509,15 @@ def main():
 
 ## 审查详情
 
-{chr(10).join(file_reviews)}
+"""
+    report_text = "".join([report_header, "\n".join(file_reviews), """
 
 ---
 *此代码审查由 AI 辅助完成，仅供参考。*
-"""
+"""])
     
-    # 直接调用 report_check.py
-    call_report_check(
-        title=title,
-        summary=summary,
-        text=report_text,
-        conclusion=conclusion
-    )
+    # 在进程内调用 report_check.py，报告文本不经过命令行参数，也不受其长度限制
+    call_report_check(title, summary, report_text, conclusion)
     
     # 如果有高严重性问题，以非零状态退出
     if high_severity_issues > 0:
@@ -8,39 +8,183 @@ Uses OpenAI's API to evaluate PR quality and provide improvement suggestions.
 import os
 import sys
 import json
-import time
-import subprocess
+import asyncio
+import hashlib
+import tempfile
 from pathlib import Path
-from openai import OpenAI
 
-def call_report_check(title, summary, text, conclusion):
-    """调用 report_check.py 生成报告"""
-    script_dir = Path(__file__).parent
-    report_script = script_dir / "report_check.py"
+from report_check import call_report_check
+
+# 安装了 orjson 时用它解析和序列化 JSON，未安装时回退到标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        """序列化为 UTF-8 字节，与 orjson.dumps 的返回值一致"""
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+# 设置 LLM_CACHE=1 时按 (模型, prompt) 的哈希缓存评估结果，PR 未修改时重复运行无需再次调用 API
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE') == '1'
+LLM_CACHE_DIR = Path(os.environ.get('LLM_CACHE_DIR', '/tmp/llm_cache'))
+
+# 评估结果的最大 token 数，避免模型输出过长
+MAX_RESPONSE_TOKENS = int(os.environ.get('LLM_MAX_TOKENS', 1000))
+
+# 评估 PR 的 prompt 模板，只需填充标题和描述
+_PROMPT_TEMPLATE = """
+You are an expert code reviewer tasked with evaluating the quality of a GitHub Pull Request.
+Analyze the following PR title and description to determine if it meets high-quality standards.
+
+PR Title: {title}
+PR Description:
+{body}
+
+Evaluate based on these criteria:
+1. Clarity: Is the purpose of the PR clearly communicated?
+2. Completeness: Does it explain what changes were made and why?
+3. Technical Detail: Are implementation details sufficiently explained?
+4. Testing: Is there information about how the changes were tested?
+
+Report your evaluation by calling the grade_pr function.
+"""
+
+# 评估结果通过函数调用返回，参数格式由 JSON Schema 约束，无需在 prompt 中描述
+_GRADE_PR_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "grade_pr",
+        "description": "Report the quality evaluation of the pull request",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "quality_score": {"type": "integer", "minimum": 1, "maximum": 10},
+                "is_acceptable": {"type": "boolean", "description": "true if quality_score >= 6"},
+                "strengths": {"type": "array", "items": {"type": "string"}},
+                "improvement_suggestions": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Specific suggestions for improvement"
+                },
+                "explanation": {"type": "string", "description": "Brief explanation of the evaluation"}
+            },
+            "required": ["quality_score", "is_acceptable", "strengths", "improvement_suggestions", "explanation"]
+        }
+    }
+}
+
+# 评估结果中每个字段的类型，用于校验函数调用的参数（未启用 strict 模式时不保证符合 schema）
+_RESULT_FIELD_TYPES = {
+    "quality_score": int,
+    "is_acceptable": bool,
+    "strengths": list,
+    "improvement_suggestions": list,
+    "explanation": str
+}
+
+_EMOJI_MAP = {
+    1: "🚨", 2: "🚨", 3: "🚨", 4: "⚠️", 5: "⚠️",
+    6: "👍", 7: "👍", 8: "✅", 9: "🌟", 10: "🌟"
+}
+
+def is_valid_evaluation(result):
+    """检查评估结果包含所有字段且类型正确"""
+    return isinstance(result, dict) and all(
+        isinstance(result.get(key), field_type)
+        # bool 是 int 的子类，评分不能是 true/false
+        and not (field_type is int and isinstance(result[key], bool))
+        for key, field_type in _RESULT_FIELD_TYPES.items()
+    )
+
+def load_cached_evaluation(cache_key):
+    """读取缓存的评估结果，不存在、无法解析或不完整时返回 None"""
+    try:
+        result = json_loads((LLM_CACHE_DIR / f"{cache_key}.json").read_bytes())
+    except (OSError, ValueError):
+        return None
+    return result if is_valid_evaluation(result) else None
+
+def write_cache_file(path, write):
+    """先写临时文件再替换，保证缓存文件始终完整"""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=path.parent, suffix='.tmp', delete=False) as f:
+            write(f)
+        os.replace(f.name, path)
+    except OSError as e:
+        print(f"WARNING: 写入缓存失败: {e}")
+
+def store_cached_evaluation(cache_key, result):
+    """缓存评估结果"""
+    data = json_dumps(result)
+    write_cache_file(LLM_CACHE_DIR / f"{cache_key}.json", lambda f: f.write(data))
+
+async def request_evaluation(client, model_name, prompt, attempt, previous=None):
+    """调用一次 OpenAI API 并解析 grade_pr 函数调用的参数
+
+    前一次尝试超过 2 * 2**attempt 秒仍未返回时，后续尝试与其并发开始，由调用方取用最先成功的结果；
+    前一次尝试失败时，先等待 2**attempt 秒再重试。
+    """
+    if previous is not None:
+        done, _ = await asyncio.wait([previous], timeout=2 * 2 ** attempt)
+        if done:
+            # 前一次尝试成功时调用方会取消本任务，走到这里说明它已失败，退避后再重试
+            await asyncio.sleep(2 ** attempt)
     
-    # 确保报告脚本存在
-    if not report_script.exists():
-        print(f"ERROR: 找不到报告脚本: {report_script}")
-        return False
+    print(f"🤖 使用 {model_name} 评估 PR (尝试 #{attempt + 1})...")
+    stream = await client.chat.completions.create(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.3,
+        max_tokens=MAX_RESPONSE_TOKENS,
+        tools=[_GRADE_PR_TOOL],
+        tool_choice={"type": "function", "function": {"name": "grade_pr"}},
+        stream=True
+    )
     
-    try:
-        subprocess.run([
-            "python", str(report_script),
-            "--title", title,
-            "--summary", summary,
-            "--text", text,
-            "--conclusion", conclusion
-        ], check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: 调用报告脚本失败: {e}")
-        return False
-
-def evaluate_pr_with_llm(title, body):
+    # Accumulate the streamed function arguments and stop as soon as they parse as a complete JSON object
+    parts = []
+    async with stream:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = "".join(
+                tool_call.function.arguments or ""
+                for tool_call in chunk.choices[0].delta.tool_calls or []
+                if tool_call.function
+            )
+            parts.append(delta)
+            if "}" in delta:
+                try:
+                    result = json_loads("".join(parts))
+                except json.JSONDecodeError:
+                    continue
+                break
+        else:
+            content = "".join(parts)
+            try:
+                result = json_loads(content)
+            except json.JSONDecodeError:
+                print(f"Error parsing grade_pr arguments from API response: {content[:200]}...")
+                raise
+    
+    # 字段缺失或类型不对时视为本次尝试失败，由后续尝试重新评估，也不会写入缓存
+    if not is_valid_evaluation(result):
+        raise ValueError(f"grade_pr arguments are incomplete: {json.dumps(result, ensure_ascii=False)[:200]}")
+    return result
+
+async def evaluate_pr_with_llm(title, body):
     """Evaluate PR quality using OpenAI API"""
     # Get API key and model from env vars
     api_key = os.environ.get('OPENAI_API_KEY')
-    model_name = os.environ.get('MODEL_NAME', 'gpt-4')
+    model_name = os.environ.get('MODEL_NAME', 'gpt-4o-mini')
 
     if not api_key:
         print("❌ Error: OPENAI_API_KEY environment variable is not set")
@@ -53,63 +197,48 @@ def evaluate_pr_with_llm(title, body):
         )
         sys.exit(1)
     
-    # Initialize OpenAI client
-    client = OpenAI(api_key=api_key)
-    
     # Create the prompt for the LLM
-    prompt = f"""
-You are an expert code reviewer tasked with evaluating the quality of a GitHub Pull Request.
-Analyze the following PR title and description to determine if it meets high-quality standards.
-
-PR Title: {title}
-PR Description:
-{body}
-
-Evaluate based on these criteria:
-1. Clarity: Is the purpose of the PR clearly communicated?
-2. Completeness: Does it explain what changes were made and why?
-3. Technical Detail: Are implementation details sufficiently explained?
-4. Testing: Is there information about how the changes were tested?
-
-Respond with a JSON object containing:
-{{
-  "quality_score": [1-10 integer score],
-  "is_acceptable": [boolean, true if score >= 6],
-  "strengths": [array of strengths],
-  "improvement_suggestions": [array of specific suggestions for improvement],
-  "explanation": [brief explanation of your evaluation]
-}}
-"""
+    prompt = _PROMPT_TEMPLATE.format(title=title, body=body)
 
+    cache_key = hashlib.sha256(f"{model_name}\0{prompt}".encode('utf-8')).hexdigest()
+    if LLM_CACHE_ENABLED:
+        cached = load_cached_evaluation(cache_key)
+        if cached is not None:
+            print(f"INFO: 使用缓存的评估结果 ({cache_key[:12]})")
+            return cached
+    
     # Maximum retries for API call
     max_retries = 3
-    retry_count = 0
     
-    while retry_count < max_retries:
+    # 延迟导入 openai/httpx，缺少参数等提前退出的情况无需承担导入开销
+    import httpx
+    from openai import AsyncOpenAI
+    
+    # HTTP/2 让并发的评估请求在同一个连接上多路复用
+    async with AsyncOpenAI(api_key=api_key, http_client=httpx.AsyncClient(http2=True)) as client:
+        tasks = []
+        for attempt in range(max_retries):
+            previous = tasks[-1] if tasks else None
+            tasks.append(asyncio.create_task(
+                request_evaluation(client, model_name, prompt, attempt, previous)
+            ))
+        
         try:
-            print(f"🤖 使用 {model_name} 评估 PR...")
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            # Extract the response content
-            content = response.choices[0].message.content
-            
-            try:
-                result = json.loads(content)
-                return result
-            except json.JSONDecodeError:
-                print(f"Error parsing JSON from API response: {content[:200]}...")
-                retry_count += 1
-                time.sleep(2)
+            # 取最先成功返回的结果，其余尝试随即取消
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    result = await next_done
+                except Exception as e:
+                    print(f"Error calling OpenAI API: {e}")
+                    continue
                 
-        except Exception as e:
-            print(f"Error calling OpenAI API: {e}")
-            retry_count += 1
-            time.sleep(2)
+                if LLM_CACHE_ENABLED:
+                    store_cached_evaluation(cache_key, result)
+                return result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
     
     print("❌ Failed to get a valid response from the OpenAI API after multiple retries")
     # 直接调用 report_check.py 报告错误
@@ -123,13 +252,10 @@ Respond with a JSON object containing:
 
 def format_feedback_text(result):
     """Format the LLM feedback as a report text"""
-    emoji_map = {
-        1: "🚨", 2: "🚨", 3: "🚨", 4: "⚠️", 5: "⚠️",
-        6: "👍", 7: "👍", 8: "✅", 9: "🌟", 10: "🌟"
-    }
-    
     score = result["quality_score"]
-    emoji = emoji_map.get(score, "🔍")
+    emoji = _EMOJI_MAP.get(score, "🔍")
+    strengths = "\n".join(f"- {s}" for s in result["strengths"])
+    suggestions = "\n".join(f"- {s}" for s in result["improvement_suggestions"])
     
     report_text = f"""
 ## {emoji} PR 质量评估
@@ -137,10 +263,10 @@ def format_feedback_text(result):
 **评分: {score}/10** - {result["explanation"]}
 
 ### 优点
-{chr(10).join([f"- {s}" for s in result["strengths"]])}
+{strengths}
 
 ### 改进建议
-{chr(10).join([f"- {s}" for s in result["improvement_suggestions"]])}
+{suggestions}
 
 ---
 *此评估由 AI 生成，仅供参考。*
@@ -160,20 +286,19 @@ def main():
     print(f"DEBUG: PR 描述长度: {len(pr_body)} 字符")
     
     # Run LLM evaluation
-    evaluation = evaluate_pr_with_llm(pr_title, pr_body)
-    
-    # Print results
-    print(f"🤖 LLM 质量评分: {evaluation['quality_score']}/10")
-    print(f"🤖 是否可接受: {'是' if evaluation['is_acceptable'] else '否'}")
-    print("\n🤖 优点:")
-    for strength in evaluation['strengths']:
-        print(f"  - {strength}")
-    
-    print("\n🤖 改进建议:")
-    for suggestion in evaluation['improvement_suggestions']:
-        print(f"  - {suggestion}")
+    evaluation = asyncio.run(evaluate_pr_with_llm(pr_title, pr_body))
     
-    print(f"\n🤖 评价: {evaluation['explanation']}")
+    # Print results in a single write
+    lines = [
+        f"🤖 LLM 质量评分: {evaluation['quality_score']}/10",
+        f"🤖 是否可接受: {'是' if evaluation['is_acceptable'] else '否'}",
+        "\n🤖 优点:",
+        *(f"  - {strength}" for strength in evaluation['strengths']),
+        "\n🤖 改进建议:",
+        *(f"  - {suggestion}" for suggestion in evaluation['improvement_suggestions']),
+        f"\n🤖 评价: {evaluation['explanation']}",
+    ]
+    print("\n".join(lines))
     
     # Format the feedback
     report_text = format_feedback_text(evaluation)
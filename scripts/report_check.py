@@ -8,7 +8,42 @@ import os
 import sys
 import json
 import argparse
-import requests
+import functools
+
+# 安装了 orjson 时用它序列化请求体，未安装时回退到标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+@functools.lru_cache(maxsize=1)
+def get_http_client():
+    """同一进程内的多次检查结果提交共用一个 HTTP/2 连接，建立连接失败时自动重试
+
+    httpx 在首次提交时才导入，缺少环境变量等提前返回的情况无需承担导入开销。
+    """
+    import httpx
+    return httpx.Client(
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_keepalive_connections=4)
+        ),
+        timeout=httpx.Timeout(15.0, connect=5.0),
+        headers={
+            "Accept": "application/vnd.github.v3+json",
+            "Content-Type": "application/json"
+        }
+    )
+
+def encode_payload(data):
+    """把请求体序列化为字节，orjson 拒绝的字符串（例如含有代理字符）回退到标准库处理"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(data).encode('utf-8')
 
 def create_check_run(title, summary, text, conclusion):
     """创建检查结果"""
@@ -24,12 +59,6 @@ def create_check_run(title, summary, text, conclusion):
     print(f"DEBUG: 创建检查结果 '{title}' 在仓库 {repo}, SHA: {sha[:7]}")
     url = f"https://api.github.com/repos/{repo}/check-runs"
     
-    headers = {
-        "Accept": "application/vnd.github.v3+json",
-        "Authorization": f"token {token}",
-        "Content-Type": "application/json"
-    }
-    
     data = {
         "name": check_name,
         "head_sha": sha,
@@ -43,8 +72,10 @@ def create_check_run(title, summary, text, conclusion):
     }
     
     try:
+        # 直接发送序列化后的字节，Content-Type 已在客户端默认请求头中设置
+        body = encode_payload(data)
         print(f"INFO: 发送检查结果到 GitHub API")
-        response = requests.post(url, headers=headers, json=data)
+        response = get_http_client().post(url, headers={"Authorization": f"token {token}"}, content=body)
         print(f"DEBUG: 响应状态码: {response.status_code}")
         
         if response.status_code == 201:
@@ -58,23 +89,13 @@ def create_check_run(title, summary, text, conclusion):
         print(f"ERROR: 提交检查结果时出错: {e}")
         return False
 
-def main():
-    """主函数"""
-    parser = argparse.ArgumentParser(description='提交检查结果到 GitHub Checks API')
-    parser.add_argument('--title', required=False, default="验证检查", help='检查结果标题')
-    parser.add_argument('--summary', required=False, default="执行了验证检查。", help='检查结果摘要')
-    parser.add_argument('--text', required=False, default="没有详细信息可用。", help='检查结果详细文本')
-    parser.add_argument('--conclusion', required=False, default="neutral", 
-                        choices=['success', 'failure', 'neutral', 'cancelled', 'skipped', 'timed_out'],
-                        help='检查结果结论')
-    
-    args = parser.parse_args()
-    
+def run(title, summary, text, conclusion):
+    """提交检查结果，失败时打印结果以便查看，返回是否提交成功"""
     # 检查参数是否为空，如果为空则使用默认值
-    title = args.title if args.title else "验证检查"
-    summary = args.summary if args.summary else "执行了验证检查。"
-    text = args.text if args.text else "没有详细信息可用。"
-    conclusion = args.conclusion if args.conclusion else "neutral"
+    title = title if title else "验证检查"
+    summary = summary if summary else "执行了验证检查。"
+    text = text if text else "没有详细信息可用。"
+    conclusion = conclusion if conclusion else "neutral"
     
     print(f"DEBUG: 使用以下参数创建检查: 标题='{title}', 结论='{conclusion}'")
     
@@ -95,7 +116,31 @@ def main():
         print(f"详细内容:\n{text}")
         print("=====================\n")
     
-    sys.exit(0 if success or conclusion == 'success' else 1)
+    return success
+
+def call_report_check(title, summary, text, conclusion):
+    """供其他脚本在进程内提交检查结果，出错时只打印错误而不中断调用方"""
+    try:
+        return run(title, summary, text, conclusion)
+    except Exception as e:
+        print(f"ERROR: 调用报告脚本失败: {e}")
+        return False
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='提交检查结果到 GitHub Checks API')
+    parser.add_argument('--title', required=False, default="验证检查", help='检查结果标题')
+    parser.add_argument('--summary', required=False, default="执行了验证检查。", help='检查结果摘要')
+    parser.add_argument('--text', required=False, default="没有详细信息可用。", help='检查结果详细文本')
+    parser.add_argument('--conclusion', required=False, default="neutral", 
+                        choices=['success', 'failure', 'neutral', 'cancelled', 'skipped', 'timed_out'],
+                        help='检查结果结论')
+    
+    args = parser.parse_args()
+    
+    success = run(args.title, args.summary, args.text, args.conclusion)
+    
+    sys.exit(0 if success or args.conclusion == 'success' else 1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file